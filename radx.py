@@ -2,12 +2,19 @@ import argparse
 import logging
 from os import listdir
 from os.path import join, isdir, exists
+import shutil
 import sys
-import pandas as pd
-from multiprocessing import Queue
+import time
+from multiprocessing import Pool, Queue
 
 from radx import SRAProcess
-from radx import GISAIDDownloader
+from radx.memory import MemoryEstimator, disk_usage, input_size, memory_backed, process_rss
+from radx.progress import ProgressMonitor, stop_process_tree
+
+# seconds between checks on running samples
+POLL_INTERVAL = 2
+# seconds a stopped sample gets to clean up before it is killed
+STOP_GRACE = 60
 
 logging.basicConfig(format='%(asctime)s: %(levelname)s:%(message)s',
                     filemode='a', filename='logs/radx.log',
@@ -26,31 +33,127 @@ def process(args):
         sra_files = [x for x in sra_files if x in included_files]
     sra_files = sorted(list(set(sra_files)))
     logging.info("Processing %s samples", len(sra_files))
-    # If multiprocessing is enabled launch processes in a batch
+    # If multiprocessing is enabled launch processes in parallel
     if args.multiproc:
-        for i in range(0, len(sra_files), args.maxproc):
-            batch = sra_files[i:i+args.maxproc]
-            logging.info("Starting batch %s", batch)
-            processes = []
-            q = Queue()
-            for sra_file in batch[:]:
-                logging.info("Processing %s", sra_file)
-                # TODO : Probably better to pass overwrite with start
-                sra_proc = SRAProcess(sra_file,
-                                      args.input,
-                                      args.output,
-                                      overwrite=args.overwrite,
-                                      queue=q)
-                sra_proc.start()
-                processes.append(sra_proc)
-            [proc.join() for proc in processes]
-            logging.info("Finished batch %s", batch)
-        logging.info("Done")
+        launch(args, sra_files, args.maxproc)
     else:
-        for sra_file in sra_files[:]:
-            logging.info("Processing %s", sra_file)
-            sra_proc = SRAProcess(sra_file)
+        launch(args, sra_files, 1)
+    logging.info("Done")
+
+def new_process(args, sra_file, q):
+    # TODO : Probably better to pass overwrite with start
+    return SRAProcess(sra_file,
+                      args.input,
+                      args.output,
+                      overwrite=args.overwrite,
+                      queue=q,
+                      cram=args.cram,
+                      fastq_gz=args.fastq_gz,
+                      keep_untrimmed=args.keep_untrimmed,
+                      threads=args.threads,
+                      scratch_dir=args.scratch,
+                      scratch_cap=args.scratch_cap,
+                      sort_mem=args.sort_mem,
+                      min_af=args.min_af,
+                      ivar_min_af=args.ivar_min_af)
+
+def launch(args, sra_files, maxproc):
+    """Start samples as slots free up, admitting new samples only
+       while their estimated memory fits within the memory budget"""
+    budget = int(args.mem_budget * 1024**3) if args.mem_budget else None
+    estimator = MemoryEstimator(args.output) if budget else None
+    # files in a tmpfs scratch directory use memory that is not part of the rss
+    shm_scratch = bool(budget and args.scratch and memory_backed(args.scratch))
+    pending = list(sra_files)
+    # sample name -> process, event queue, input bytes, estimated peak, observed
+    # peak, the time the sample was stopped for running over the stage timeout
+    # and whether it had to be killed
+    running = {}
+    monitor = ProgressMonitor(len(pending), join(args.output, "progress.jsonl"), args.stage_timeout)
+    while pending or running:
+        for sample in running.values():
+            drain_events(monitor, sample)
+        for name, stage in monitor.stuck():
+            if name in running and not running[name]["stopped"]:
+                monitor.killed(name, stage)
+                stop_process_tree(running[name]["proc"])
+                running[name]["stopped"] = time.time()
+        for name in list(running):
+            sample = running[name]
+            if budget:
+                usage = process_rss(sample["proc"].pid)
+                if shm_scratch:
+                    usage += disk_usage(join(args.scratch, name))
+                sample["peak"] = max(sample["peak"], usage)
+            if not sample["proc"].is_alive():
+                sample["proc"].join()
+                drain_events(monitor, sample)
+                sample["queue"].close()
+                logging.info("Finished %s with exit code %s", name, sample["proc"].exitcode)
+                monitor.exited(name, sample["proc"].exitcode)
+                # a sample that did not finish may have left its scratch directory
+                if sample["proc"].exitcode != 0 and args.scratch:
+                    shutil.rmtree(join(args.scratch, name), ignore_errors=True)
+                if budget and sample["proc"].exitcode == 0 and sample["peak"] > 0:
+                    estimator.record(name, sample["in_bytes"], sample["peak"])
+                del running[name]
+            elif sample["stopped"] and not sample["killed"] and time.time() - sample["stopped"] > STOP_GRACE:
+                logging.error("Sample %s did not stop in %ss, killing it", name, STOP_GRACE)
+                sample["proc"].kill()
+                sample["killed"] = True
+        while pending and len(running) < maxproc:
+            in_bytes, estimate = 0, 0
+            if budget:
+                in_bytes = input_size(args.input, pending[0])
+                estimate = estimator.estimate(in_bytes)
+                committed = sum([max(x["estimate"], x["peak"]) for x in running.values()])
+                if running and committed + estimate > budget:
+                    break
+                if estimate > budget:
+                    logging.warning("Estimated memory for %s exceeds the budget, running it alone", pending[0])
+            sra_file = pending.pop(0)
+            logging.info("Processing %s (estimated memory %.2f GB)", sra_file, estimate / 1024**3)
+            # each sample gets its own queue, so killing one that is writing to
+            # it cannot corrupt or lock the queue used by the other samples
+            q = Queue()
+            sra_proc = new_process(args, sra_file, q)
             sra_proc.start()
+            running[sra_file] = {"proc": sra_proc, "queue": q, "in_bytes": in_bytes,
+                                 "estimate": estimate, "peak": 0, "stopped": None, "killed": False}
+        monitor.report()
+        time.sleep(POLL_INTERVAL)
+    monitor.report(force=True)
+    monitor.close()
+
+def drain_events(monitor, sample):
+    # the queue of a killed sample may be corrupt, so its remaining events are dropped
+    if not sample["killed"]:
+        monitor.drain(sample["queue"])
+
+def remerge(args):
+    """Rewrite merged variants and metrics of processed samples from their
+       stored ivar and lofreq calls without running the tools again"""
+    samples = [x for x in listdir(args.output) if isdir(join(args.output, x)) and
+               any([exists(join(args.output, x, x+y)) for y in ["_ivar.tsv", "_lofreq.vcf"]])]
+    if args.include:
+        included_files = [x.strip() for x in args.include.split(",")]
+        samples = [x for x in samples if x in included_files]
+    logging.info("Remerging calls for %s samples", len(samples))
+    jobs = [(join(args.output, x), x, args.min_af, args.ivar_min_af) for x in sorted(samples)]
+    with Pool(args.maxproc if args.multiproc else 1) as pool:
+        for name, count in pool.imap_unordered(remerge_job, jobs, chunksize=16):
+            if count is not None:
+                logging.info("Remerged %s with %s variants", name, count)
+    logging.info("Done")
+
+def remerge_job(job):
+    from radx.utils import remerge_sample
+    # a single corrupt call file should not stop the remerge of the other samples
+    try:
+        return remerge_sample(*job)
+    except Exception as e:
+        logging.error("--- ERROR encountered when remerging '%s'    Message: '%s'", job[1], repr(e))
+        return job[1], None
 
 def summarize(args):
     with open(join(args.output, "metrics.tsv"), "w") as ofile:
@@ -66,12 +169,11 @@ def summarize(args):
                 print("\t".join([x, "", "", "", ""]), file=ofile)
 
 def download_gisaid():
-    # download data
-    gdownloader = GISAIDDownloader()
-    gdownloader.dump_gisaid_data()
-    # download metadata
+    # selenium and the rest of the download stack are only loaded here
+    from radx import GISAIDDownloader
+    # download data and metadata in one session
     gdownloader = GISAIDDownloader()
-    gdownloader.dump_gisaid_metadata()
+    gdownloader.dump_gisaid()
 
 def main():
     '''Main method : parse input arguments and train'''
@@ -90,10 +192,43 @@ def main():
                         help='Use multiprocessing to run jobs in parallel')
     parser.add_argument('--maxproc', type=int, default=4,
                         help='Max processes to run in parallel')
+    parser.add_argument('--cram', action='store_true',
+                        help='Store trimmed alignments as reference based CRAM instead of BAM')
+    parser.add_argument('--fastq-gz', action='store_true',
+                        help='Write trimmed reads as bgzip compressed fastq.gz files')
+    parser.add_argument('--drop-untrimmed', dest='keep_untrimmed', action='store_false',
+                        help='Delete the untrimmed sorted BAM during cleanup')
+    parser.add_argument('--threads', type=int, default=4,
+                        help='Threads used by samtools for compression per sample')
+    parser.add_argument('--scratch', type=str, default=None,
+                        help='Node local directory (e.g. /dev/shm) to run samples in before moving kept files to output')
+    parser.add_argument('--scratch-cap', type=float, default=None,
+                        help='Max disk usage in GB per sample in the scratch directory')
+    parser.add_argument('--mem-budget', type=float, default=None,
+                        help='Memory in GB shared by concurrent samples, calibrated from earlier runs. '
+                             'Scratch usage is counted when --scratch is on a tmpfs such as /dev/shm')
+    parser.add_argument('--sort-mem', type=str, default="768M",
+                        help='Memory per thread passed to samtools sort -m')
+    parser.add_argument('--stage-timeout', type=float, default=None,
+                        help='Kill samples that spend more than this many seconds in a single stage')
+    parser.add_argument('--remerge', action='store_true',
+                        help='Only reapply merging and filtering to stored ivar and lofreq calls')
+    parser.add_argument('--min-af', type=float, default=0.05,
+                        help='Min allele frequency of merged variant calls')
+    parser.add_argument('--ivar-min-af', type=float, default=0.01,
+                        help='Min allele frequency of ivar calls before merging')
     args = parser.parse_args()
+    if args.stage_timeout:
+        try:
+            import psutil
+        except ImportError:
+            parser.error("--stage-timeout requires psutil to stop the tools of stuck samples")
 
-    # first process the inputs
-    process(args)
+    # first process the inputs or only redo the merging of variant calls
+    if args.remerge:
+        remerge(args)
+    else:
+        process(args)
     # summarize
     summarize(args)
 
@@ -1,5 +1,35 @@
-from .utils import *
-from .settings import *
-from .data import *
-from .downloader import *
-from .pipeline import *
+"""Submodules are loaded lazily on first attribute access so that the
+   pipeline and its worker processes don't pay for the download stack.
+"""
+import importlib
+
+_LAZY = {
+    "GENE_MAP": "utils",
+    "read_ivar": "utils",
+    "read_lofreq": "utils",
+    "annotate_mutations": "utils",
+    "merge_calls": "utils",
+    "filter_merged_calls": "utils",
+    "merge_sample_calls": "utils",
+    "variant_list": "utils",
+    "remerge_sample": "utils",
+    "disk_usage": "memory",
+    "GISAIDRecord": "data",
+    "GISAIDDownloader": "downloader",
+    "VariantDownloader": "downloader",
+    "SRAProcess": "pipeline",
+}
+
+def __getattr__(name):
+    if name in _LAZY:
+        module = importlib.import_module("." + _LAZY[name], __name__)
+        return getattr(module, name)
+    # settings hold system specific variables which are not known in advance
+    if name.isupper():
+        settings = importlib.import_module(".settings", __name__)
+        if hasattr(settings, name):
+            return getattr(settings, name)
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY))
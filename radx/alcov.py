@@ -1,10 +1,147 @@
+"""File containing the in process coverage analysis of BAM files
+"""
 import logging
+import re
+
+import numpy as np
+
+from radx.utils import GENE_MAP
+
+# positions with depth above this count towards breadth of coverage
+MIN_DEPTH = 10
+# reads that samtools depth skips by default: secondary, qcfail and duplicates
+DEPTH_SKIP_FLAGS = 0x100 | 0x200 | 0x400
+# number of aligned blocks collected before they are added to the depth arrays
+CHUNK_SIZE = 1000000
+# primer name suffixes, e.g. nCoV-2019_1_LEFT or amplicon_12_R
+PRIMER_SIDE = re.compile(r"[_-](LEFT|RIGHT|L|R|F|FWD|FORWARD|REV|REVERSE)(_ALT\d*)?$", re.IGNORECASE)
+
+def read_amplicons(primer_bed):
+    """Amplicon inserts between the left and right primers of each pair"""
+    primers = {}
+    for line in open(primer_bed):
+        fields = line.strip().split("\t")
+        if len(fields) < 4 or line.startswith(("#", "track", "browser")):
+            continue
+        match = PRIMER_SIDE.search(fields[3])
+        stranded = len(fields) >= 6 and fields[5] in ["+", "-"]
+        # both primers of a pair may share the amplicon name, e.g. swift
+        # covid19genome_0-200_s0_M1, and are then told apart by strand
+        if not match and not stranded:
+            continue
+        name = fields[3][:match.start()] if match else fields[3]
+        if stranded:
+            left = fields[5] == "+"
+        else:
+            left = match.group(1).upper()[0] in ["L", "F"]
+        pair = primers.setdefault((fields[0], name), {"left": [], "right": []})
+        pair["left" if left else "right"].append((int(fields[1]), int(fields[2])))
+    amplicons = []
+    for (ref, name), pair in primers.items():
+        if pair["left"] and pair["right"]:
+            start = max([x[1] for x in pair["left"]])
+            end = min([x[0] for x in pair["right"]])
+            if start < end:
+                amplicons.append((ref, name, start, end))
+    return sorted(amplicons, key=lambda x: (x[0], x[2]))
 
 class BAMAnalyzer(object):
-    def __init__(self, name, bam_path):
+    def __init__(self, name, bam_path, primer_bed=None, min_depth=MIN_DEPTH):
         self.name = name
         self.path = bam_path
+        self.primer_bed = primer_bed
+        self.min_depth = min_depth
+        # depth array for each reference and count of mapped reads
+        self.depths = {}
+        self.count = 0
 
     def run(self):
+        """Fill depth arrays for every reference in a single pass over the BAM"""
         logging.info("Running analysis for %s", self.name)
- 
\ No newline at end of file
+        import pysam
+        self.count = 0
+        with pysam.AlignmentFile(self.path, "rb") as bam:
+            lengths = dict(zip(bam.references, bam.lengths))
+            # depth changes at block starts and ends, summed up at the end
+            diffs = {ref: np.zeros(length+1, dtype=np.int64) for ref, length in lengths.items()}
+            blocks = {ref: ([], []) for ref in lengths}
+            pending = 0
+            for read in bam.fetch(until_eof=True):
+                if read.is_unmapped:
+                    continue
+                self.count += 1
+                if read.flag & DEPTH_SKIP_FLAGS:
+                    continue
+                starts, ends = blocks[read.reference_name]
+                for start, end in read.get_blocks():
+                    starts.append(start)
+                    ends.append(end)
+                pending += 1
+                if pending >= CHUNK_SIZE:
+                    self.add_blocks(diffs, blocks)
+                    pending = 0
+            self.add_blocks(diffs, blocks)
+        self.depths = {ref: np.cumsum(diff[:-1]) for ref, diff in diffs.items()}
+        return self
+
+    @staticmethod
+    def add_blocks(diffs, blocks):
+        for ref, (starts, ends) in blocks.items():
+            if starts:
+                size = len(diffs[ref])
+                diffs[ref] += np.bincount(starts, minlength=size)[:size]
+                diffs[ref] -= np.bincount(ends, minlength=size)[:size]
+                del starts[:], ends[:]
+
+    def all_depths(self):
+        if not self.depths:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(list(self.depths.values()))
+
+    def breadth(self):
+        depth = self.all_depths()
+        return 100 * np.count_nonzero(depth > self.min_depth) / len(depth) if len(depth) else 0
+
+    def mean(self):
+        depth = self.all_depths()
+        return depth.mean() if len(depth) else 0
+
+    def region_coverage(self, ref, start, end):
+        """Mean depth and breadth of a 0-based half open region"""
+        depth = self.depths[ref][start:end]
+        if not len(depth):
+            return 0, 0
+        return depth.mean(), 100 * np.count_nonzero(depth > self.min_depth) / len(depth)
+
+    def gene_coverage(self):
+        if not self.depths:
+            return []
+        # genes are on the single SARS-CoV-2 reference with 1-based positions
+        ref = next(iter(self.depths))
+        return [(ref, gene, first-1, last) + self.region_coverage(ref, first-1, last)
+                for gene, (first, last) in GENE_MAP.items()]
+
+    def amplicon_coverage(self):
+        if not self.primer_bed:
+            return []
+        amplicons = [x for x in read_amplicons(self.primer_bed) if x[0] in self.depths]
+        if not amplicons:
+            logging.warning("No primer pairs found in %s", self.primer_bed)
+        return [(ref, name, start, end) + self.region_coverage(ref, start, end)
+                for ref, name, start, end in amplicons]
+
+    def write_depth(self, filename):
+        """Write depth of every position like samtools depth -a"""
+        with open(filename, "w") as ofile:
+            for ref, depth in self.depths.items():
+                for pos, dep in enumerate(depth.tolist(), start=1):
+                    ofile.write("%s\t%s\t%s\n" % (ref, pos, dep))
+
+    def write_coverage(self, filename):
+        """Write mean depth and breadth of each gene and amplicon"""
+        with open(filename, "w") as ofile:
+            print("\t".join(["type", "region", "name", "start", "end", "mean", "breadth"]), file=ofile)
+            for rtype, regions in [("gene", self.gene_coverage()), ("amplicon", self.amplicon_coverage())]:
+                for ref, name, start, end, mean, breadth in regions:
+                    print("\t".join([rtype, ref, name, str(start), str(end),
+                                     "%.6g" % mean, "%.6g" % breadth]), file=ofile)
@@ -0,0 +1,65 @@
+"""Import time budgets for the modules loaded by the pipeline CLI and its
+   sample processes. Run with: python -m radx.benchmark
+"""
+import subprocess
+import sys
+import time
+
+# cumulative import time budgets as multiples of the startup time of a bare
+# interpreter (python -c pass), so that they hold on slower and faster machines
+BUDGETS = {"radx": 1,
+           "radx.memory": 2,
+           "radx.pipeline": 5}
+# modules that should only be loaded when they are used
+DEFERRED = ["pandas", "numpy", "vcf", "selenium", "requests", "pysam"]
+
+def startup_time(runs=5):
+    """Fastest wall clock time in ms of starting a bare interpreter"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times)
+
+def import_times(module):
+    """Cumulative import time in ms of every module loaded by importing module"""
+    ret = subprocess.run([sys.executable, "-X", "importtime", "-c", "import "+module],
+                         capture_output=True, text=True)
+    if ret.returncode != 0:
+        lines = ret.stderr.strip().splitlines()
+        raise ImportError(lines[-1] if lines else "exit code %s" % ret.returncode)
+    times = {}
+    # lines look like: import time:   self [us] | cumulative | imported package
+    for line in ret.stderr.splitlines():
+        fields = line.split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        times[fields[2].strip()] = int(fields[1].strip()) / 1000
+    return times
+
+def main():
+    failures = []
+    baseline = startup_time()
+    print("%-16s %8.1f ms" % ("python -c pass", baseline))
+    for module, factor in BUDGETS.items():
+        budget = factor * baseline
+        try:
+            times = import_times(module)
+        except ImportError as e:
+            print("%-16s   failed to import" % module)
+            failures.append("%s could not be imported: %s" % (module, e))
+            continue
+        elapsed = times.get(module, 0)
+        print("%-16s %8.1f ms (budget %.1f ms)" % (module, elapsed, budget))
+        if elapsed > budget:
+            failures.append("%s took %.1f ms" % (module, elapsed))
+        eager = [x for x in DEFERRED if x in times]
+        if eager:
+            failures.append("%s loads %s" % (module, ", ".join(eager)))
+    for failure in failures:
+        print("FAILED:", failure)
+    sys.exit(1 if failures else 0)
+
+if __name__ == '__main__':
+    main()
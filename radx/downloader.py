@@ -1,11 +1,15 @@
 """This file contains methods for downloading resources 
    needed for the RADx pipeline automatically.
 """
+import hashlib
 import json
 import logging
+import lzma
 import os
 import re
+import shutil
 import tarfile
+import tempfile
 import time
 
 import numpy as np
@@ -14,130 +18,208 @@ import requests
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
 
 from radx.settings import (GISAID_PASSWORD, GISAID_USERNAME, PATH_TO_DOWNLOADS,
                            PATH_TO_GISAID, PATH_TO_MUTATIONS, PATH_TO_ALCOV)
 
 
+GISAID_URL = "https://www.epicov.org/epi3/start"
+# suffixes used by browsers for files that are still being written
+PARTIAL_SUFFIXES = (".crdownload", ".part", ".tmp")
+
+def get_download_dir():
+    if PATH_TO_DOWNLOADS:
+        return PATH_TO_DOWNLOADS
+    from pathlib import Path
+    return str(Path.home() / "Downloads")
+
+def file_checksum(path, chunk_size=1024*1024):
+    sha = hashlib.sha256()
+    with open(path, "rb") as ifile:
+        for chunk in iter(lambda: ifile.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def extract_archive(path, dest_dir):
+    """Extract a .tar.xz archive into dest_dir in a single pass. The archive is
+       extracted into a temporary directory first, so an incomplete or corrupt
+       archive never replaces earlier extracted files."""
+    tmp_dir = tempfile.mkdtemp(prefix=".extract_", dir=dest_dir)
+    try:
+        try:
+            with tarfile.open(path, "r:xz") as tar:
+                tar.extractall(tmp_dir)
+        except (tarfile.TarError, EOFError, lzma.LZMAError) as e:
+            raise RuntimeError("Incomplete or corrupt archive " + path + ": " + repr(e))
+        names = os.listdir(tmp_dir)
+        if not names:
+            raise RuntimeError("Empty archive " + path)
+        for name in names:
+            dst = os.path.join(dest_dir, name)
+            if os.path.isdir(dst) and not os.path.islink(dst):
+                shutil.rmtree(dst)
+            elif os.path.lexists(dst):
+                os.remove(dst)
+            os.replace(os.path.join(tmp_dir, name), dst)
+        return names
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
 class GISAIDDownloader(object):
-    def __init__(self, driver="chrome"):
+    def __init__(self, driver="chrome", url=GISAID_URL, down_dir=None, timeout=60,
+                 download_timeout=3600, poll_interval=2, stable_polls=3):
         self.uname = GISAID_USERNAME
         self.passwd = GISAID_PASSWORD
-        self.driver = webdriver.Chrome() if driver=="chrome" else webdriver.Firefox()
+        self.url = url
+        self.down_dir = down_dir if down_dir else get_download_dir()
+        # a webdriver instance can be passed in to run against a stand-in page
+        if driver == "chrome":
+            self.driver = webdriver.Chrome()
+        elif driver == "firefox":
+            self.driver = webdriver.Firefox()
+        else:
+            self.driver = driver
+        self.wait = WebDriverWait(self.driver, timeout)
+        self.download_timeout = download_timeout
+        self.poll_interval = poll_interval
+        self.stable_polls = stable_polls
+
+    def dump_gisaid(self):
+        """Download sequences and metadata in a single logged in session"""
+        # the browser is closed even when a page or download times out
+        try:
+            self.login()
+            started = time.time()
+            self.download_fasta()
+            sequence_file, sequence_sum = self.wait_for_download("sequence_fasta_", started)
+            self.driver.switch_to.default_content()
+            started = time.time()
+            self.download_metadata()
+            metadata_file, metadata_sum = self.wait_for_download("metadata_tsv_", started)
+        finally:
+            self.shutdown_driver()
+        self.move_sequence_file(sequence_file, sequence_sum)
+        self.move_metadata_file(metadata_file, metadata_sum)
 
     def dump_gisaid_data(self):
-        self.login()
-        self.download_fasta()
-        self.wait_for_download()
-        self.shutdown_driver()
-        self.move_sequence_file()
+        try:
+            self.login()
+            started = time.time()
+            self.download_fasta()
+            sequence_file, sequence_sum = self.wait_for_download("sequence_fasta_", started)
+        finally:
+            self.shutdown_driver()
+        self.move_sequence_file(sequence_file, sequence_sum)
 
     def dump_gisaid_metadata(self):
-        self.login()
-        self.download_metadata()
-        self.wait_for_download()
-        self.shutdown_driver()
-        self.move_metadata_file()
+        try:
+            self.login()
+            started = time.time()
+            self.download_metadata()
+            metadata_file, metadata_sum = self.wait_for_download("metadata_tsv_", started)
+        finally:
+            self.shutdown_driver()
+        self.move_metadata_file(metadata_file, metadata_sum)
 
     def login(self):
-        self.driver.get("https://www.epicov.org/epi3/start")
-        assert "GISAID" in self.driver.title
+        self.driver.get(self.url)
+        self.wait.until(EC.title_contains("GISAID"))
 
-        unamefld = self.driver.find_element_by_id("elogin")
+        unamefld = self.wait.until(EC.presence_of_element_located((By.ID, "elogin")))
         unamefld.clear()
         unamefld.send_keys(self.uname)
 
-        passwdfld = self.driver.find_element_by_id("epassword")
+        passwdfld = self.driver.find_element(By.ID, "epassword")
         passwdfld.clear()
         passwdfld.send_keys(self.passwd)
 
         passwdfld.send_keys(Keys.RETURN)
-        time.sleep(3)
+        self.wait.until(EC.presence_of_element_located((By.XPATH, '//div[text()="Downloads"]')))
+
+    def click(self, xpath):
+        self.wait.until(EC.element_to_be_clickable((By.XPATH, xpath))).click()
+
+    def switch_to_dialog(self):
+        self.wait.until(EC.frame_to_be_available_and_switch_to_it((By.XPATH, "//iframe[@src='about:blank']")))
 
     def download_fasta(self):
-        self.driver.find_element(By.XPATH, '//div[text()="Downloads"]').click()
-        time.sleep(3)
-        iframe = self.driver.find_element_by_xpath("//iframe[@src='about:blank']")
-        self.driver.switch_to.frame(iframe)
-        self.driver.find_element(By.XPATH, '//div[text()="FASTA"]').click()
-        time.sleep(2)
-        iframe = self.driver.find_element_by_xpath("//iframe[@src='about:blank']")
-        self.driver.switch_to.frame(iframe)
-        self.driver.find_element(By.XPATH, '//input[@type="checkbox"]').click()
-        time.sleep(2)
-        self.driver.find_element(By.XPATH, '//button[text()="Download"]').click()
-        time.sleep(5)
+        self.click('//div[text()="Downloads"]')
+        self.switch_to_dialog()
+        self.click('//div[text()="FASTA"]')
+        self.switch_to_dialog()
+        self.click('//input[@type="checkbox"]')
+        self.click('//button[text()="Download"]')
 
     def download_metadata(self):
-        self.driver.find_element(By.XPATH, '//div[text()="Downloads"]').click()
-        time.sleep(3)
-        iframe = self.driver.find_element_by_xpath("//iframe[@src='about:blank']")
-        self.driver.switch_to.frame(iframe)
-        self.driver.find_element(By.XPATH, '//div[text()="metadata"]').click()
-        time.sleep(2)
-        iframe = self.driver.find_element_by_xpath("//iframe[@src='about:blank']")
-        self.driver.switch_to.frame(iframe)
-        self.driver.find_element(By.XPATH, '//input[@type="checkbox"]').click()
-        time.sleep(2)
-        self.driver.find_element(By.XPATH, '//button[text()="Download"]').click()
+        self.click('//div[text()="Downloads"]')
+        self.switch_to_dialog()
+        self.click('//div[text()="metadata"]')
+        self.switch_to_dialog()
+        self.click('//input[@type="checkbox"]')
+        self.click('//button[text()="Download"]')
 
-    def wait_for_download(self):
-        time.sleep(90)
+    def wait_for_download(self, prefix, started=0):
+        """Wait until an archive starting with prefix is fully downloaded and
+           return its path and checksum. A download is complete when no partial
+           files are left and its size stays the same for a few polls."""
+        deadline = time.time() + self.download_timeout
+        last_size, stable = None, 0
+        while time.time() < deadline:
+            time.sleep(self.poll_interval)
+            files = os.listdir(self.down_dir)
+            if any([x.endswith(PARTIAL_SUFFIXES) for x in files]):
+                last_size, stable = None, 0
+                continue
+            archives = [x for x in files if x.startswith(prefix) and x.endswith("tar.xz")
+                        and os.path.getmtime(os.path.join(self.down_dir, x)) >= started]
+            if not archives:
+                continue
+            src_file = os.path.join(self.down_dir, sorted(archives, reverse=True)[0])
+            size = os.path.getsize(src_file)
+            stable = stable + 1 if size == last_size else 0
+            last_size = size
+            if stable >= self.stable_polls:
+                logging.info("Downloaded %s with %s bytes", src_file, size)
+                return src_file, file_checksum(src_file)
+        raise TimeoutError("Download of " + prefix + " did not finish in " + self.down_dir)
 
     def shutdown_driver(self):
         self.driver.close()
 
-    def move_metadata_file(self):
-        if PATH_TO_DOWNLOADS:
-            down_dir = PATH_TO_DOWNLOADS
-        else:
-            from pathlib import Path
-            down_dir = str(Path.home() / "Downloads") 
-        work_dir = PATH_TO_GISAID
-        try:
-            metadata_files = [x for x in os.listdir(down_dir) if x[:13]=="metadata_tsv_" and x[-6:]=="tar.xz"]
-            metadata_arxiv = sorted(metadata_files, reverse=True)[0]
-            src_file = os.path.join(down_dir, metadata_arxiv)
-            dst_file = os.path.join(work_dir, metadata_arxiv)
-            # delete if the archive file and directory exists
-            if os.path.exists(dst_file):
-                os.rmdir(dst_file)
-            if os.path.exists(dst_file[:-6]):
-                os.rmdir(dst_file[:-6])
-            # move the file and extract
-            os.rename(src_file, dst_file)
-            if os.path.exists(dst_file):
-                tar = tarfile.open(dst_file, "r:xz")
-                tar.extractall(work_dir)
-                tar.close()
-        except PermissionError as _:
-            logging.info("Permission error in path: %s. Please move files manually.", down_dir)
+    def move_metadata_file(self, src_file=None, checksum=None):
+        self.move_archive("metadata_tsv_", src_file, checksum)
 
-    def move_sequence_file(self):
-        if PATH_TO_DOWNLOADS:
-            down_dir = PATH_TO_DOWNLOADS
-        else:
-            from pathlib import Path
-            down_dir = str(Path.home() / "Downloads") 
+    def move_sequence_file(self, src_file=None, checksum=None):
+        self.move_archive("sequence_fasta_", src_file, checksum)
+
+    def move_archive(self, prefix, src_file=None, checksum=None):
         work_dir = PATH_TO_GISAID
         try:
-            metadata_files = [x for x in os.listdir(down_dir) if x[:15]=="sequence_fasta_" and x[-6:]=="tar.xz"]
-            metadata_arxiv = sorted(metadata_files, reverse=True)[0]
-            src_file = os.path.join(down_dir, metadata_arxiv)
-            dst_file = os.path.join(work_dir, metadata_arxiv)
+            if src_file is None:
+                archives = [x for x in os.listdir(self.down_dir) if x.startswith(prefix) and x[-6:]=="tar.xz"]
+                src_file = os.path.join(self.down_dir, sorted(archives, reverse=True)[0])
+            # make sure the file did not change after the download was detected
+            if checksum is not None and file_checksum(src_file) != checksum:
+                raise RuntimeError("Checksum mismatch for downloaded file " + src_file)
+            # GISAID publishes no reference hash, so the archive is checked to
+            # be intact while it is extracted, before anything is replaced
+            extract_archive(src_file, work_dir)
+            dst_file = os.path.join(work_dir, os.path.basename(src_file))
             # delete if the archive file and directory exists
             if os.path.exists(dst_file):
-                os.rmdir(dst_file)
-            if os.path.exists(dst_file[:-6]):
-                os.rmdir(dst_file[:-6])
-            # move the file and extract
-            os.rename(src_file, dst_file)
-            if os.path.exists(dst_file):
-                tar = tarfile.open(dst_file, "r:xz")
-                tar.extractall(work_dir)
-                tar.close()
+                os.remove(dst_file)
+            if os.path.isdir(dst_file[:-6]):
+                shutil.rmtree(dst_file[:-6])
+            elif os.path.exists(dst_file[:-6]):
+                os.remove(dst_file[:-6])
+            shutil.move(src_file, dst_file)
+            if checksum is not None:
+                with open(dst_file+".sha256", "w") as ofile:
+                    print(checksum, os.path.basename(dst_file), file=ofile)
         except PermissionError as _:
-            logging.info("Permission error in path: %s. Please move files manually.", down_dir)
+            logging.info("Permission error in path: %s. Please move files manually.", self.down_dir)
 
 class VariantDownloader(object):
     def __init__(self):
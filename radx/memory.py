@@ -0,0 +1,94 @@
+"""This file contains methods for tracking the memory used by sample
+   processes and estimating the memory needed by new samples.
+"""
+import logging
+import os
+from os.path import abspath, exists, join
+from stat import S_ISLNK
+
+# Estimates used until earlier runs have been recorded
+DEFAULT_BASE_MB = 1024
+DEFAULT_MB_PER_INPUT_MB = 2.0
+CALIBRATION_FILE = "memory_calibration.tsv"
+
+def process_rss(pid):
+    """Resident memory in bytes of a process and all of its children"""
+    import psutil
+    try:
+        proc = psutil.Process(pid)
+        procs = [proc] + proc.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+    rss = 0
+    for proc in procs:
+        try:
+            rss += proc.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    return rss
+
+def disk_usage(path):
+    # total size in bytes of the files under path, links are not followed
+    total = 0
+    for root, _, files in os.walk(path):
+        for fname in files:
+            # tools keep creating and deleting temporary files while this runs
+            try:
+                stat = os.lstat(os.path.join(root, fname))
+            except OSError:
+                continue
+            if not S_ISLNK(stat.st_mode):
+                total += stat.st_size
+    return total
+
+def memory_backed(path):
+    """True if path is on a tmpfs such as /dev/shm, where files use memory"""
+    import psutil
+    path = abspath(path)
+    mounts = [x for x in psutil.disk_partitions(all=True)
+              if path == x.mountpoint or path.startswith(x.mountpoint.rstrip("/") + "/")]
+    if not mounts:
+        return False
+    return max(mounts, key=lambda x: len(x.mountpoint)).fstype == "tmpfs"
+
+def input_size(in_dir, name):
+    """Combined size in bytes of the R1 and R2 fastq.gz files of a sample"""
+    total = 0
+    for suffix in ["_R1.fastq.gz", "_R2.fastq.gz"]:
+        fpath = join(in_dir, name+suffix)
+        if exists(fpath):
+            total += os.path.getsize(fpath)
+    return total
+
+class MemoryEstimator(object):
+    def __init__(self, out_dir):
+        # fail before any sample is started rather than on the first poll
+        try:
+            import psutil
+        except ImportError:
+            raise ImportError("psutil is required for memory aware scheduling with --mem-budget")
+        self.path = join(out_dir, CALIBRATION_FILE)
+        # peak memory observed for samples as (input bytes, peak bytes)
+        self.history = []
+        if exists(self.path):
+            for line in open(self.path):
+                fields = line.strip().split("\t")
+                if len(fields) == 3 and fields[1].isdigit() and fields[2].isdigit():
+                    self.history.append((int(fields[1]), int(fields[2])))
+        logging.info("Loaded %s memory calibration records", len(self.history))
+
+    def estimate(self, in_bytes):
+        """Estimated peak memory in bytes for a sample with in_bytes of input"""
+        base = DEFAULT_BASE_MB * 1024**2
+        ratio = DEFAULT_MB_PER_INPUT_MB
+        if self.history:
+            # use the most memory hungry sample seen so far to stay on the safe side
+            ratios = [max(peak - base, 0) / in_size for in_size, peak in self.history if in_size > 0]
+            if ratios:
+                ratio = max(ratios)
+        return int(base + ratio * in_bytes)
+
+    def record(self, name, in_bytes, peak_bytes):
+        self.history.append((in_bytes, peak_bytes))
+        with open(self.path, "a") as ofile:
+            print("\t".join([name, str(in_bytes), str(peak_bytes)]), file=ofile)
@@ -2,50 +2,115 @@
 """
 import logging
 import os
+import shutil
+import signal
 import subprocess
 import time
-import pandas as pd
 from multiprocessing import Process, Queue
 from os import chdir, listdir, makedirs, remove, removedirs, system
-from os.path import exists, isdir, isfile, join
+from os.path import abspath, exists, isdir, isfile, islink, join
 
 from radx.settings import PATH_TO_HOSTING, PATH_TO_REFS, PATH_TO_AGGREGATE
-from radx.utils import (read_ivar, read_lofreq, merge_calls,
-                        filter_merged_calls)
 
 class SRAProcess(Process):
-    def __init__(self, fname, in_dir, out_dir, overwrite=False, queue=None):
+    def __init__(self, fname, in_dir, out_dir, overwrite=False, queue=None,
+                 cram=False, fastq_gz=False, keep_untrimmed=True, threads=4,
+                 scratch_dir=None, scratch_cap=None, sort_mem=None,
+                 min_af=0.05, ivar_min_af=0.01):
         super(SRAProcess, self).__init__()
         self.name = fname
         self.in_dir = in_dir
         self.out_dir = out_dir
         self.overwrite = overwrite
+        # queue for stage events read by the launcher
+        self.queue = queue
+        # commands that failed in the current stage
+        self.failed_cmds = []
+        # output format options
+        self.cram = cram                        # keep reference based cram instead of bam
+        self.fastq_gz = fastq_gz                # write bgzip compressed fastq files
+        self.keep_untrimmed = keep_untrimmed    # keep the untrimmed sorted bam
+        self.threads = threads
+        # node local working directory and its disk usage cap in GB
+        self.scratch_dir = scratch_dir
+        self.scratch_cap = scratch_cap
+        # memory per thread for samtools sort
+        self.sort_mem = sort_mem
+        # allele frequency cutoffs for merged calls and ivar calls
+        self.min_af = min_af
+        self.ivar_min_af = ivar_min_af
 
     def run(self):
         logging.info("Running job for %s", self.name)
-        self.sdir = join(self.out_dir, self.name)
+        # the launcher stops stuck samples with SIGTERM
+        signal.signal(signal.SIGTERM, self.handle_sigterm)
+        self.sdir = abspath(join(self.out_dir, self.name))
+        # all intermediate files are written to the work dir which is
+        # the sample directory unless a scratch directory is configured
+        if self.scratch_dir:
+            self.wdir = abspath(join(self.scratch_dir, self.name))
+        else:
+            self.wdir = self.sdir
         # The trimmed sorted file is one of the final files used
         # so skip running the process if it exists already
         final_bam_file = join(self.sdir, self.name+".trimmed.sorted.bam")
         if not self.overwrite and exists(final_bam_file):
             logging.info("Found existing file %s. Skipping processing.", final_bam_file)
             logging.info("To process sample again, please use the overwrite flag.")
+        # files left in scratch by a crashed or killed run may be incomplete
+        if self.wdir != self.sdir and exists(self.wdir):
+            logging.info("Removing leftover scratch directory %s", self.wdir)
+            shutil.rmtree(self.wdir)
+        # kept files are only moved to the sample dir once every stage ran
+        self.completed = False
         # Process the input files
-        self.prep()
-        self.align()
-        self.trim_to_bam()
-        self.variants()
-        # Analyze files
-        self.collect_metrics()
-        self.plot()
-        # Perform logistics and cleanup
-        self.move_files()
-        self.cleanup()
+        try:
+            self.run_stage(self.prep)
+            self.run_stage(self.align)
+            self.run_stage(self.trim_to_bam)
+            self.run_stage(self.variants)
+            # Analyze files
+            self.run_stage(self.collect_metrics)
+            self.run_stage(self.plot)
+            # Perform logistics and cleanup
+            self.run_stage(self.move_files)
+            self.run_stage(self.cleanup)
+            self.completed = True
+        finally:
+            self.run_stage(self.persist)
+
+    def handle_sigterm(self, signum, frame):
+        # ignore further signals so that persist can remove the scratch directory
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        # SystemExit is not caught by the exception handling in run_cmd
+        raise SystemExit("Sample " + self.name + " was stopped")
+
+    def run_stage(self, stage):
+        name = stage.__name__
+        start = time.time()
+        self.failed_cmds = []
+        self.send_event("start", name, start)
+        try:
+            stage()
+        except BaseException as e:
+            self.send_event("fail", name, time.time(), time.time()-start, repr(e))
+            raise
+        # tool failures are only logged by run_cmd, so report them here
+        if self.failed_cmds:
+            self.send_event("fail", name, time.time(), time.time()-start, "; ".join(self.failed_cmds))
+        else:
+            self.send_event("finish", name, time.time(), time.time()-start)
+
+    def send_event(self, event, stage, timestamp, duration=None, message=None):
+        # events are compact tuples of the sample, event and stage details
+        if self.queue is not None:
+            self.queue.put((self.name, event, stage, timestamp, duration, message))
 
     def prep(self):
         logging.info("Prepping for %s", self.name)
-        if not isdir(self.sdir):
-            makedirs(self.sdir)
+        for wdir in [self.sdir, self.wdir]:
+            if not isdir(wdir):
+                makedirs(wdir)
         self.log_path = self.name+"_radx.log"
         self.std_out = self.name+"_stdout_radx.log"
         # Source files
@@ -57,21 +122,28 @@ class SRAProcess(Process):
         # some of the important output files to indicate pipeline processing
         self.sort_bam = self.name+".sorted.bam"
         self.trim_sort_bam = self.name+".trimmed.sorted.bam"
+        self.trim_sort_cram = self.name+".trimmed.sorted.cram"
         # move files if not fully processed or they don't exist already
-        if not exists(join(self.sdir, self.trim_sort_bam)) or self.overwrite:
+        processed = any([exists(join(self.sdir, x)) for x in [self.trim_sort_bam, self.trim_sort_cram]])
+        if not processed or self.overwrite:
             for sfile in [self.sra_r1, self.sra_r2]:
-                if not isfile(join(self.sdir, sfile)):
-                    self.run_cmd(["cp", join(self.in_dir, sfile), self.sdir])
+                if not isfile(join(self.wdir, sfile)):
+                    self.run_cmd(["cp", join(self.in_dir, sfile), self.wdir])
+        # link previous outputs into scratch so that finished steps are skipped
+        if self.wdir != self.sdir and not self.overwrite:
+            for sfile in listdir(self.sdir):
+                if not exists(join(self.wdir, sfile)):
+                    os.symlink(join(self.sdir, sfile), join(self.wdir, sfile))
         # TODO: verify if the following are needed for each record
         # or if they can be just done once and referred across SRA jobs
         for sfile in [self.ref_fa, self.ref_gff, self.primer_bed]:
-            if not isfile(join(self.sdir, sfile)):
-                self.run_cmd(["cp", join(PATH_TO_REFS, sfile), self.sdir])
+            if not isfile(join(self.wdir, sfile)):
+                self.run_cmd(["cp", join(PATH_TO_REFS, sfile), self.wdir])
         # Update paths to job specific directory
         if isdir("radx"):
-            chdir(self.sdir)
-            logging.info("Changed directory to work dir: %s", self.sdir)
-            logging.info("Logging will be continued in: %s", join(self.sdir, self.log_path))
+            chdir(self.wdir)
+            logging.info("Changed directory to work dir: %s", self.wdir)
+            logging.info("Logging will be continued in: %s", join(self.wdir, self.log_path))
         for handler in logging.root.handlers[:]:
             logging.root.removeHandler(handler)
         logging.basicConfig(format='%(asctime)s: Sample '+self.name+' %(levelname)s:%(message)s',
@@ -91,9 +163,15 @@ class SRAProcess(Process):
         self.sort_dep = self.name+".sorted.depth"
         self.trim_sort_dep = self.name+".trimmed.sorted.depth"
         self.trim_sort_bai = self.name+".trimmed.sorted.bam.bai"
-        self.out_r1 = self.name+"_R1.fastq"
-        self.out_r2 = self.name+"_R2.fastq"
-        
+        if self.fastq_gz:
+            # source files are named _R1.fastq.gz, so avoid overwriting them
+            self.out_r1 = self.name+".trimmed_R1.fastq.gz"
+            self.out_r2 = self.name+".trimmed_R2.fastq.gz"
+        else:
+            self.out_r1 = self.name+"_R1.fastq"
+            self.out_r2 = self.name+"_R2.fastq"
+        self.trim_sort_crai = self.name+".trimmed.sorted.cram.crai"
+
         self.trim_sort_indelqual = self.name+"_trim_sort_indelqual"
         self.final_lofreq = self.name+"_lofreq.vcf"
         self.variants_merged = self.name+"_variants_merged.tsv"
@@ -102,96 +180,123 @@ class SRAProcess(Process):
         self.freyja_variants = self.name+"_freyja_variants.tsv"
         self.freyja_summary = self.name+"_freyja_summary.tsv"
         self.metrics = self.name+"_metrics.tsv"
+        self.coverage = self.name+"_coverage.tsv"
+        self.analyzer = None
 
     def align(self):
-        if not exists(self.sort_bam) or self.overwrite:
+        # alignment is done if the sorted bam or the trimmed alignments exist
+        if self.overwrite or not (exists(self.sort_bam) or self.aligned()):
             # first align to reference sequence
             self.run_cmd(["bwa", "index", self.ref_fa])
             self.run_cmd(["bwa", "mem", "-t", "32", self.ref_fa, self.sra_r1, self.sra_r2,
                         "|", "samtools", "view", "-b", "-F", "4",
-                        "|", "samtools","sort", "-o", self.sort_bam])
+                        "|", "samtools","sort"] + self.sort_opts() + ["-o", self.sort_bam])
+
+    def sort_opts(self):
+        return ["-m", self.sort_mem] if self.sort_mem else []
+
+    def bam_analysis(self):
+        # scan the trimmed bam once and reuse the depth arrays across steps
+        if self.analyzer is None:
+            from radx.alcov import BAMAnalyzer
+            self.analyzer = BAMAnalyzer(self.name, self.trim_sort_bam, self.primer_bed).run()
+        return self.analyzer
+
+    def aligned(self):
+        """Trimmed alignments from an earlier run exist as indexed bam or cram"""
+        return ((exists(self.trim_sort_bam) and exists(self.trim_sort_bai)) or
+                (exists(self.trim_sort_cram) and exists(self.trim_sort_crai)))
+
+    def decode_cram(self):
+        # only the cram is kept, so decode it when a later step needs the alignments
+        if not exists(self.trim_sort_bam) and exists(self.trim_sort_cram):
+            self.run_cmd(["samtools", "view", "-@", str(self.threads), "-b", "-T", self.ref_fa,
+                          "-o", self.trim_sort_bam, self.trim_sort_cram])
+            self.run_cmd(["samtools", "index", self.trim_sort_bam])
 
     def trim_to_bam(self):
-        if not exists(self.trim_sort_bam) or self.overwrite:
+        if self.overwrite or not self.aligned():
             #trimming primers and base quality
             self.run_cmd(["ivar", "trim", "-b", self.primer_bed, "-p", self.trim, "-i", self.sort_bam])
             #checking trimmed vs non trimmed
-            self.run_cmd(["samtools", "sort", "-o", self.trim_sort_bam, self.trim_bam])
+            self.run_cmd(["samtools", "sort"] + self.sort_opts() + ["-o", self.trim_sort_bam, self.trim_bam])
             # index the sortedbam file
-        if not exists(self.trim_sort_bai) or self.overwrite:
+        if exists(self.trim_sort_bam) and (not exists(self.trim_sort_bai) or self.overwrite):
             self.run_cmd(["samtools", "index", self.trim_sort_bam])
             # get depth of the trimmed and sorted bam file for later
         if not exists(self.trim_sort_dep) or self.overwrite:
-            self.run_cmd(["samtools", "depth", "-a", self.trim_sort_bam, ">", self.trim_sort_dep])
+            self.decode_cram()
+            if not exists(self.trim_sort_bam):
+                logging.warning("Cannot find the bam file :%s . Cannot write depth.", self.trim_sort_bam)
+            else:
+                try:
+                    self.bam_analysis().write_depth(self.trim_sort_dep)
+                except Exception as e:
+                    logging.info("--- ERROR encountered when analyzing '%s'    Message: '%s'",
+                                 self.trim_sort_bam, repr(e))
             # convert to fastq.gz for uploads
         if not exists(self.out_r1) or not exists(self.out_r2) or self.overwrite:
-            self.run_cmd(["bedtools", "bamtofastq", "-i", self.trim_sort_bam, "-fq", self.out_r1, "-fq2", self.out_r2])
+            self.decode_cram()
+            if self.fastq_gz:
+                # stream name collated reads straight into multithreaded bgzf compressed fastq
+                self.run_cmd(["samtools", "collate", "-@", str(self.threads), "-u", "-O", self.trim_sort_bam,
+                              "|", "samtools", "fastq", "-@", str(self.threads), "-n",
+                              "-1", self.out_r1, "-2", self.out_r2, "-0", "/dev/null", "-s", "/dev/null", "-"])
+            else:
+                self.run_cmd(["bedtools", "bamtofastq", "-i", self.trim_sort_bam, "-fq", self.out_r1, "-fq2", self.out_r2])
+            # store alignments as reference based cram for long term storage
+        if self.cram and (not exists(self.trim_sort_cram) or self.overwrite):
+            self.run_cmd(["samtools", "view", "-@", str(self.threads), "-C", "-T", self.ref_fa,
+                          "-o", self.trim_sort_cram, self.trim_sort_bam])
+            self.run_cmd(["samtools", "index", self.trim_sort_cram])
 
     def variants(self):
         # Run ivar to get variants
         if not exists(self.final_ivar) or self.overwrite:
+            self.decode_cram()
             self.run_cmd(["samtools", "mpileup", "-aa", "-A", "-B", "-d", "0", "--reference " +self.ref_fa+ " -Q", "0", self.trim_sort_bam,
                           "|", "ivar", "variants", "-p", self.final_ivar, "-t", "0", "-q", "20", "-m", "10", "-r", self.ref_fa, "-g", self.ref_gff])
         # Run lofreq to get variants
         if not exists(self.final_lofreq) or self.overwrite:
+            self.decode_cram()
             self.run_cmd(["lofreq", "indelqual", "--dindel", "-f", self.ref_fa, self.trim_sort_bam, "-o", self.trim_sort_indelqual])
             self.run_cmd(["lofreq", "call", "-f", self.ref_fa, "--call-indels", "-o", self.final_lofreq, self.trim_sort_indelqual])
         # variants are recorded in metrics, so don't run this if it exists
         if not exists(self.metrics) or self.overwrite:
-            # Read ivar and lofreq
-            ivar_calls = read_ivar(self.final_ivar) if exists(self.final_ivar) else pd.DataFrame()
-            if len(ivar_calls.index) == 0:
-                logging.warning("Empty ivar dataframe :%s", self.final_ivar)
-            lofreq_calls = read_lofreq(self.final_lofreq) if exists(self.final_lofreq) else pd.DataFrame()
-            if len(lofreq_calls.index) == 0:
-                logging.warning("Empty lofreq dataframe :%s", self.final_lofreq)
-            merged_calls = merge_calls(ivar_calls, lofreq_calls)
-            filtered_merged_calls = filter_merged_calls(merged_calls)
+            # pandas is only needed here, so load it when calls are merged
+            from radx.utils import merge_sample_calls, variant_list
+            filtered_merged_calls = merge_sample_calls(self.final_ivar, self.final_lofreq,
+                                                       min_af=self.min_af, ivar_min_af=self.ivar_min_af)
             filtered_merged_calls.to_csv(self.variants_merged, sep="\t", index=False)
             with open("variants.csv", "w") as ofile:
-                if "Variant" in filtered_merged_calls.columns.tolist():
-                    print(",".join(filtered_merged_calls["Variant"].tolist()), end="", file=ofile)
-                else:
-                    print("", file=ofile)
+                print(variant_list(filtered_merged_calls), end="", file=ofile)
 
     def collect_metrics(self):
         if not exists(self.metrics) or self.overwrite:
-            if not exists(self.trim_sort_bam):
+            if not self.aligned():
                 logging.warning("Cannot find the bam file :%s . Cannot collect metrics.", self.trim_sort_bam)
             else:
+                self.decode_cram()
                 # "Sample", "Breadth of coverage", "Total read count", "Mean reads"
-                breadth, count, mean, variants = "final.bam.breadth", "final.bam.count", "final.bam.mean", "variants.csv"
-                self.run_cmd(["samtools", "depth", "-a", self.trim_sort_bam, "|", 
-                            "awk '{c++; if($3>10) total+=1} END {print total*100/c}'",
-                            ">", breadth], redirect=False)
-                self.run_cmd(["samtools", "view", "-c", "-F", "4", self.trim_sort_bam, ">", count], redirect=False)
-                self.run_cmd(["samtools", "depth", "-a", self.trim_sort_bam, "|", 
-                            "awk '{c++;s+=$3}END{print s/c}'", ">", mean], redirect=False)
-                if exists(breadth):
-                    breadth = [y for y in open(breadth)]
-                    breadth = breadth[0].strip() if breadth else "0" 
-                else:
-                    breadth = "0" 
-                if exists(count):
-                    count = [y for y in open(count)]
-                    count = count[0].strip() if count else "0" 
-                else:
-                    count = "0" 
-                if exists(mean):
-                    mean = [y for y in open(mean)]
-                    mean = mean[0].strip() if mean else "0" 
-                else:
-                    mean = "0" 
+                breadth, count, mean = "0", "0", "0"
+                try:
+                    analyzer = self.bam_analysis()
+                    breadth, count, mean = "%.6g" % analyzer.breadth(), str(analyzer.count), "%.6g" % analyzer.mean()
+                    analyzer.write_coverage(self.coverage)
+                except Exception as e:
+                    logging.info("--- ERROR encountered when analyzing '%s'    Message: '%s'",
+                                 self.trim_sort_bam, repr(e))
+                variants = "variants.csv"
                 if exists(variants):
                     variants = [y for y in open(variants)]
                     variants = variants[0].strip() if variants else "" 
                 else:
                     variants = "0" 
-                    with open(self.metrics, "w") as ofile:
-                        ofile.write("\t".join([self.name, breadth, count, mean, variants]))
+                with open(self.metrics, "w") as ofile:
+                    ofile.write("\t".join([self.name, breadth, count, mean, variants]))
 
     def plot(self):
-        if not exists(self.trim_sort_bam):
+        if not self.aligned():
             logging.warning("Cannot find the bam file :%s", self.trim_sort_bam)
         else:
             # use samtools to get stats and then plot
@@ -201,6 +306,7 @@ class SRAProcess(Process):
 
             # run freyja variant generation - this has to be done again for some reason
             if not exists(self.freyja_variants) or self.overwrite:
+                self.decode_cram()
                 self.run_cmd(["samtools mpileup -aa -A -d 600000 -Q 20 -q 0 -B -f", self.ref_fa, self.trim_sort_bam, "|",
                               "tee >(cut -f1-4 > "+self.trim_sort_dep+")", "|",
                               "ivar variants -p", self.freyja_variants, "-q 20 -t 0.0 -r", self.ref_fa])
@@ -225,16 +331,9 @@ class SRAProcess(Process):
             for cfile in files_to_copy:
                 self.run_cmd(["cp", cfile, PATH_TO_AGGREGATE])
 
-    def cleanup(self):
-        logging.info("Running cleanup for %s", self.name)
-        if isdir("radx"):
-            chdir(self.sdir)
-        filelist = listdir()
+    def kept_files(self):
         files_to_keep = [
-                            self.sort_bam,
                             self.sort_dep,
-                            self.trim_sort_bam,
-                            self.trim_sort_bai,
                             self.trim_sort_dep,
                             self.out_r1,
                             self.out_r2,
@@ -243,12 +342,34 @@ class SRAProcess(Process):
                             self.log_path,
                             self.std_out,
                             self.metrics,                   # metrics file
+                            self.coverage,                  # gene and amplicon coverage
                             self.final_ivar,                # variants from ivar
                             self.final_lofreq,              # variants from lofreq 
                             self.variants_merged,            # merged variants
                             self.freyja_variants,
                             self.freyja_summary
                         ]
+        # untrimmed alignments are only needed to redo trimming
+        if self.keep_untrimmed:
+            files_to_keep += [self.sort_bam]
+        # retention follows the trimmed alignments on disk rather than the
+        # current flags, so the only copy of the alignments is never deleted
+        bam_indexed = exists(self.trim_sort_bam) and exists(self.trim_sort_bai)
+        cram_indexed = exists(self.trim_sort_cram) and exists(self.trim_sort_crai)
+        # cram replaces the trimmed bam once it has been written, and is
+        # only dropped without --cram once an indexed bam is present
+        if cram_indexed and (self.cram or not bam_indexed):
+            files_to_keep += [self.trim_sort_cram, self.trim_sort_crai]
+        if not (self.cram and cram_indexed):
+            files_to_keep += [self.trim_sort_bam, self.trim_sort_bai]
+        return files_to_keep
+
+    def cleanup(self):
+        logging.info("Running cleanup for %s", self.name)
+        if isdir("radx"):
+            chdir(self.wdir)
+        filelist = listdir()
+        files_to_keep = self.kept_files()
         logging.info("Current dir contents: %s", " ".join(filelist))
         files_to_delete = [x for x in filelist if x not in files_to_keep]
         logging.info("Files to delete: %s", " ".join(files_to_delete))
@@ -260,6 +381,52 @@ class SRAProcess(Process):
                 # can be dangerous to remove directory, so disabled for now
                 # removedirs(dfile)
 
+    def persist(self):
+        if self.wdir == self.sdir:
+            return
+        try:
+            # file names are only known once prep has finished
+            if not hasattr(self, "analyzer"):
+                pass
+            elif self.completed:
+                self.persist_files(self.kept_files())
+            else:
+                # outputs of a stage that raised may be truncated, so only
+                # the logs are kept and finished copies are left in place
+                logging.error("Sample %s did not finish, only moving its logs", self.name)
+                self.persist_files([self.std_out, self.log_path])
+        finally:
+            # always free the scratch space, which is memory on /dev/shm
+            if isdir(self.sdir):
+                chdir(self.sdir)
+            shutil.rmtree(self.wdir, ignore_errors=True)
+
+    def persist_files(self, files_to_keep):
+        logging.info("Moving kept files from %s to %s", self.wdir, self.sdir)
+        # move the log file last so that the move itself gets logged
+        files_to_keep = sorted(files_to_keep, key=lambda x: x == self.log_path)
+        for pfile in files_to_keep:
+            src_file = join(self.wdir, pfile)
+            # links point to outputs that are already in the sample dir
+            if not exists(src_file) or islink(src_file):
+                continue
+            # move into a temporary name on the output share and rename
+            # so that partially copied files never replace finished ones
+            dst_file = join(self.sdir, pfile)
+            tmp_file = join(self.sdir, "."+pfile+".tmp")
+            shutil.move(src_file, tmp_file)
+            if isdir(dst_file) and not islink(dst_file):
+                shutil.rmtree(dst_file)
+            os.replace(tmp_file, dst_file)
+
+    def check_scratch_usage(self):
+        from radx.memory import disk_usage
+        usage = disk_usage(self.wdir)
+        if usage > self.scratch_cap * 1024**3:
+            logging.error("Scratch usage %.2f GB exceeds cap of %s GB for %s",
+                          usage / 1024**3, self.scratch_cap, self.name)
+            raise RuntimeError("Scratch disk usage cap exceeded for " + self.name)
+
     def run_cmd(self, cmd_list, redirect=True, timeout=None):
         ret = None
         start_file_list = listdir()
@@ -305,4 +472,9 @@ class SRAProcess(Process):
         except Exception as e:
             logging.info("--- ERROR encountered when processing command '%s'    Message: '%s'", 
                          ", ".join(cmd_list), repr(e))
+        code = ret.returncode if isinstance(ret, subprocess.CompletedProcess) else ret
+        if code != 0:
+            self.failed_cmds.append("'%s' returned %s" % (" ".join(cmd_list), code))
+        if self.scratch_cap and self.wdir != self.sdir:
+            self.check_scratch_usage()
         return ret
@@ -0,0 +1,99 @@
+"""This file contains methods for following the progress of sample
+   processes from the launcher.
+"""
+import json
+import logging
+import time
+from queue import Empty
+
+# seconds between progress reports
+REPORT_INTERVAL = 30
+
+def stop_process_tree(proc):
+    """Ask a sample process to stop so that it can still clean up its scratch
+       directory, and kill the tools it has started"""
+    import psutil
+    try:
+        children = psutil.Process(proc.pid).children(recursive=True)
+    except psutil.NoSuchProcess:
+        return
+    # SIGTERM is handled by the sample process, which then runs persist
+    proc.terminate()
+    for child in children:
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+class ProgressMonitor(object):
+    def __init__(self, total, log_path, stage_timeout=None):
+        self.total = total
+        self.stage_timeout = stage_timeout
+        self.started = time.time()
+        self.reported = self.started
+        self.finished = 0
+        self.failed = 0
+        # sample name -> (stage, start time) of the stage currently running
+        self.current = {}
+        self.ofile = open(log_path, "a")
+
+    def drain(self, queue):
+        """Handle all events sent by the sample processes so far"""
+        while True:
+            try:
+                event = queue.get_nowait()
+            except Empty:
+                break
+            self.handle(*event)
+
+    def handle(self, sample, event, stage, timestamp, duration=None, message=None):
+        if event == "start":
+            self.current[sample] = (stage, timestamp)
+        elif event in ["finish", "fail"]:
+            self.current.pop(sample, None)
+        if event == "fail":
+            logging.error("Sample %s failed in %s after %.1fs: %s", sample, stage, duration, message)
+        self.write(sample, event, stage, timestamp, duration, message)
+
+    def write(self, sample, event, stage=None, timestamp=None, duration=None, message=None):
+        record = {"time": timestamp if timestamp else time.time(), "sample": sample,
+                  "event": event, "stage": stage, "duration": duration, "message": message}
+        print(json.dumps(record), file=self.ofile, flush=True)
+
+    def exited(self, sample, exitcode):
+        self.current.pop(sample, None)
+        self.finished += 1
+        if exitcode != 0:
+            self.failed += 1
+        self.write(sample, "exit", message=str(exitcode))
+
+    def stuck(self):
+        """Samples whose current stage has run longer than the stage timeout"""
+        if not self.stage_timeout:
+            return []
+        now = time.time()
+        return [(sample, stage) for sample, (stage, start) in self.current.items()
+                if now - start > self.stage_timeout]
+
+    def killed(self, sample, stage):
+        logging.error("Killing sample %s stuck in %s for over %ss", sample, stage, self.stage_timeout)
+        self.current.pop(sample, None)
+        self.write(sample, "killed", stage)
+
+    def report(self, force=False):
+        now = time.time()
+        if not force and now - self.reported < REPORT_INTERVAL:
+            return
+        self.reported = now
+        elapsed = now - self.started
+        rate = self.finished / elapsed if elapsed > 0 else 0
+        eta = (self.total - self.finished) / rate if rate > 0 else None
+        stages = ", ".join(["%s:%s" % (x, y[0]) for x, y in sorted(self.current.items())])
+        status = "Finished %s/%s samples (%s failed), %.1f samples/hour, ETA %s. Running: %s" % (
+            self.finished, self.total, self.failed, rate * 3600,
+            "%dh%02dm" % (eta // 3600, eta % 3600 // 60) if eta is not None else "unknown", stages)
+        logging.info(status)
+        print(status)
+
+    def close(self):
+        self.ofile.close()
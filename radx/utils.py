@@ -1,6 +1,6 @@
 import logging
+import os
 from os.path import exists
-import vcf
 import pandas as pd
 import numpy as np
 
@@ -31,24 +31,27 @@ def read_ivar(filename):
     return ivar_calls
 
 def read_lofreq(filename):
-    lofreq_calls = pd.DataFrame(columns=["REGION", "POS", "REF", "ALT", "QUAL", 
-                                         "REF_DP", "REF_RV", "ALT_DP", "ALT_RV",
-                                         "ALT_FREQ", "TOTAL_DP"])
+    columns = ["REGION", "POS", "REF", "ALT", "QUAL", 
+               "REF_DP", "REF_RV", "ALT_DP", "ALT_RV",
+               "ALT_FREQ", "TOTAL_DP"]
+    # collect rows first, appending to a dataframe row by row is quadratic
+    rows = []
+    import vcf
     vcf_reader = vcf.Reader(filename=filename)
     for row in vcf_reader:
-        lofreq_calls = lofreq_calls.append({"REGION": row.CHROM, 
-                                            "POS": int(row.POS),
-                                            "REF": str(row.REF),
-                                            "ALT": str(row.ALT[0]),
-                                            "QUAL": row.QUAL, 
-                                            "REF_DP": row.INFO["DP4"][0] + row.INFO["DP4"][1], 
-                                            "REF_RV": row.INFO["DP4"][1],
-                                            "ALT_DP": row.INFO["DP4"][2] + row.INFO["DP4"][3],
-                                            "ALT_RV": row.INFO["DP4"][3],
-                                            "ALT_FREQ": row.INFO["AF"],
-                                            "TOTAL_DP": row.INFO["DP"],
-                                           }, 
-                                           ignore_index=True)
+        rows.append({"REGION": row.CHROM, 
+                     "POS": int(row.POS),
+                     "REF": str(row.REF),
+                     "ALT": str(row.ALT[0]),
+                     "QUAL": row.QUAL, 
+                     "REF_DP": row.INFO["DP4"][0] + row.INFO["DP4"][1], 
+                     "REF_RV": row.INFO["DP4"][1],
+                     "ALT_DP": row.INFO["DP4"][2] + row.INFO["DP4"][3],
+                     "ALT_RV": row.INFO["DP4"][3],
+                     "ALT_FREQ": row.INFO["AF"],
+                     "TOTAL_DP": row.INFO["DP"],
+                    })
+    lofreq_calls = pd.DataFrame(rows, columns=columns)
     if lofreq_calls.empty:
         return lofreq_calls
     lofreq_calls["Variant"] = lofreq_calls.apply(lambda row:
@@ -69,12 +72,12 @@ def annotate_mutations(row):
         mutations.append(f"{gene}:{row['REF_AA']}{str(aa_pos)}{row['ALT_AA']}")
     return mutations
 
-def merge_calls(ivar, lofreq):
+def merge_calls(ivar, lofreq, ivar_min_af=0.01):
     if ivar.empty:
         return ivar
     elif lofreq.empty:
         return lofreq
-    merged = pd.concat([lofreq, ivar[ivar['ALT_FREQ'] > 0.01]], ignore_index=True)
+    merged = pd.concat([lofreq, ivar[ivar['ALT_FREQ'] > ivar_min_af]], ignore_index=True)
     # We want to keep mutations that are common in both ivar and lofreq
     ivar_snps = set([x for x in merged[merged["SOURCE"]=="ivar"]["Variant"] if "-" not in x and ":" not in x])
     lofreq_snps = set([x for x in merged[merged["SOURCE"]=="lofreq"]["Variant"] if "-" not in x and ":" not in x])
@@ -99,3 +102,40 @@ def filter_merged_calls(merged, min_af=0.05):
         return filtered_merged
     else:
         return merged
+
+def merge_sample_calls(ivar_file, lofreq_file, min_af=0.05, ivar_min_af=0.01):
+    # Read ivar and lofreq
+    ivar_calls = read_ivar(ivar_file) if exists(ivar_file) else pd.DataFrame()
+    if len(ivar_calls.index) == 0:
+        logging.warning("Empty ivar dataframe :%s", ivar_file)
+    lofreq_calls = read_lofreq(lofreq_file) if exists(lofreq_file) else pd.DataFrame()
+    if len(lofreq_calls.index) == 0:
+        logging.warning("Empty lofreq dataframe :%s", lofreq_file)
+    merged_calls = merge_calls(ivar_calls, lofreq_calls, ivar_min_af=ivar_min_af)
+    return filter_merged_calls(merged_calls, min_af=min_af)
+
+def variant_list(calls):
+    if "Variant" in calls.columns.tolist():
+        return ",".join(calls["Variant"].tolist())
+    return ""
+
+def remerge_sample(sdir, name, min_af=0.05, ivar_min_af=0.01):
+    """Reapply merge, filter and annotation to the stored ivar and lofreq
+       calls of a processed sample and rewrite its merged variants and metrics"""
+    calls = merge_sample_calls(os.path.join(sdir, name+"_ivar.tsv"),
+                               os.path.join(sdir, name+"_lofreq.vcf"),
+                               min_af=min_af, ivar_min_af=ivar_min_af)
+    calls.to_csv(os.path.join(sdir, name+"_variants_merged.tsv"), sep="\t", index=False)
+    # variants are the last column of the metrics, so only that column is
+    # rewritten and missing metrics are left for the pipeline to compute
+    metrics_file = os.path.join(sdir, name+"_metrics.tsv")
+    if not exists(metrics_file):
+        logging.warning("Missing metrics file %s. Not writing variants to metrics.", metrics_file)
+        return name, len(calls.index)
+    fields = open(metrics_file).read().strip("\n").split("\t")
+    if len(fields) != 5:
+        logging.warning("Unexpected %s columns in %s. Not writing variants to metrics.", len(fields), metrics_file)
+        return name, len(calls.index)
+    with open(metrics_file, "w") as ofile:
+        ofile.write("\t".join(fields[:4] + [variant_list(calls)]))
+    return name, len(calls.index)
@@ -0,0 +1,12 @@
+import importlib
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# settings.py is created locally from the template, fall back to the template
+# so that tests run on a fresh checkout
+try:
+    importlib.import_module("radx.settings")
+except ImportError:
+    sys.modules["radx.settings"] = importlib.import_module("radx.settings_template")
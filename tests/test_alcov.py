@@ -0,0 +1,72 @@
+import os
+import re
+
+import pytest
+
+alcov = pytest.importorskip("radx.alcov")
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+REF, REF_LEN = "NC_045512.2", 300
+# start, cigar and flag of each read: deletions, insertions, soft clips and
+# reads that samtools depth leaves out (secondary, qcfail, duplicate)
+READS = ([(50, "50M", 0)] * 12 +
+         [(0, "5S20M", 0), (10, "10M5D10M", 16), (40, "10M3I10M", 0),
+          (60, "30M", 0x100), (70, "30M", 0x200), (80, "30M", 0x400),
+          (90, "30M", 0x800), (280, "20M", 0)])
+
+
+def test_read_amplicons_swift_names():
+    amplicons = alcov.read_amplicons(os.path.join(DATA_DIR, "swift_primers.bed"))
+    # the primer without a partner on the other strand is left out
+    assert amplicons == [(REF, "covid19genome_0-200_s0_M1", 30, 190),
+                         (REF, "covid19genome_150-350_s1_M1", 172, 330)]
+
+
+def test_read_amplicons_side_suffixes(tmp_path):
+    bed = tmp_path / "primers.bed"
+    bed.write_text("\n".join([REF + "\t30\t54\tnCoV-2019_1_LEFT\tnCoV-2019_1",
+                              REF + "\t385\t410\tnCoV-2019_1_RIGHT\tnCoV-2019_1",
+                              REF + "\t380\t400\tnCoV-2019_1_RIGHT_alt2\tnCoV-2019_1"]) + "\n")
+    assert alcov.read_amplicons(str(bed)) == [(REF, "nCoV-2019_1", 54, 380)]
+
+
+@pytest.fixture
+def tiny_bam(tmp_path):
+    pysam = pytest.importorskip("pysam")
+    header = {"HD": {"VN": "1.6", "SO": "unsorted"}, "SQ": [{"SN": REF, "LN": REF_LEN}]}
+    unsorted, bam = str(tmp_path / "unsorted.bam"), str(tmp_path / "tiny.bam")
+    with pysam.AlignmentFile(unsorted, "wb", header=header) as ofile:
+        for i, (start, cigar, flag) in enumerate(READS + [(-1, None, 4)]):
+            read = pysam.AlignedSegment()
+            read.query_name = "read%s" % i
+            read.flag = flag
+            if cigar:
+                qlen = sum([int(n) for n, op in re.findall(r"(\d+)([MIS=X])", cigar)])
+                read.reference_id, read.reference_start = 0, start
+                read.cigarstring = cigar
+                read.mapping_quality = 60
+            else:
+                qlen = 20
+                read.reference_id, read.reference_start = -1, -1
+            read.query_sequence = "A" * qlen
+            read.query_qualities = pysam.qualitystring_to_array("I" * qlen)
+            ofile.write(read)
+    pysam.sort("-o", bam, unsorted)
+    pysam.index(bam)
+    return bam
+
+
+def test_bam_analyzer_matches_samtools(tiny_bam, tmp_path):
+    pysam = pytest.importorskip("pysam")
+    analyzer = alcov.BAMAnalyzer("tiny", tiny_bam).run()
+    # depth like samtools depth -a
+    depth_file = str(tmp_path / "tiny.depth")
+    analyzer.write_depth(depth_file)
+    expected_depth = pysam.samtools.depth("-a", tiny_bam)
+    assert open(depth_file).read() == expected_depth
+    # read count like samtools view -c -F 4
+    assert analyzer.count == int(pysam.samtools.view("-c", "-F", "4", tiny_bam))
+    # breadth and mean like the awk over samtools depth -a used before
+    depths = [int(x.split("\t")[2]) for x in expected_depth.strip().split("\n")]
+    assert analyzer.breadth() == pytest.approx(100 * len([x for x in depths if x > 10]) / len(depths))
+    assert analyzer.mean() == pytest.approx(sum(depths) / len(depths))
@@ -0,0 +1,202 @@
+import functools
+import hashlib
+import io
+import os
+import tarfile
+import threading
+import time
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+downloader = pytest.importorskip("radx.downloader")
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+ARCHIVES = {"FASTA": "sequence_fasta_2022_01_01.tar.xz",
+            "metadata": "metadata_tsv_2022_01_01.tar.xz"}
+
+
+def make_archive(member="metadata.tsv", content=b"strain\tdate\nhCoV-19/A/1\t2022-01-01\n" * 200):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:xz") as tar:
+        info = tarfile.TarInfo(member)
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def stub_writer(down_dir, name, data, chunks=4, delay=0.1):
+    """Write data like a browser does, into a partial file that is renamed at the end"""
+    partial = os.path.join(down_dir, name + ".crdownload")
+    step = len(data) // chunks + 1
+    with open(partial, "wb") as ofile:
+        for i in range(0, len(data), step):
+            ofile.write(data[i:i+step])
+            ofile.flush()
+            time.sleep(delay)
+    os.rename(partial, os.path.join(down_dir, name))
+
+
+def start_writer(*args, **kwargs):
+    thread = threading.Thread(target=stub_writer, args=args, kwargs=kwargs)
+    thread.start()
+    return thread
+
+
+def new_downloader(down_dir, driver=None, **kwargs):
+    options = dict(driver=driver, down_dir=str(down_dir), poll_interval=0.05,
+                   stable_polls=3, download_timeout=10)
+    options.update(kwargs)
+    return downloader.GISAIDDownloader(**options)
+
+
+def test_wait_for_download_waits_for_partial_file(tmp_path):
+    data = make_archive()
+    gdl = new_downloader(tmp_path)
+    started = time.time()
+    writer = start_writer(str(tmp_path), ARCHIVES["metadata"], data)
+    src_file, checksum = gdl.wait_for_download("metadata_tsv_", started)
+    writer.join()
+    assert src_file == os.path.join(str(tmp_path), ARCHIVES["metadata"])
+    assert not os.path.exists(src_file + ".crdownload")
+    assert checksum == hashlib.sha256(data).hexdigest()
+
+
+def test_wait_for_download_ignores_older_archives(tmp_path):
+    with open(os.path.join(str(tmp_path), "metadata_tsv_2021_01_01.tar.xz"), "wb") as ofile:
+        ofile.write(make_archive())
+    gdl = new_downloader(tmp_path, download_timeout=0.5)
+    with pytest.raises(TimeoutError):
+        gdl.wait_for_download("metadata_tsv_", time.time() + 60)
+
+
+def test_wait_for_download_times_out_on_partial_file(tmp_path):
+    with open(os.path.join(str(tmp_path), ARCHIVES["metadata"] + ".crdownload"), "wb") as ofile:
+        ofile.write(make_archive())
+    gdl = new_downloader(tmp_path, download_timeout=0.5)
+    with pytest.raises(TimeoutError):
+        gdl.wait_for_download("metadata_tsv_")
+
+
+def test_move_archive_extracts_and_records_checksum(tmp_path, monkeypatch):
+    down_dir, work_dir = tmp_path / "downloads", tmp_path / "gisaid"
+    down_dir.mkdir()
+    work_dir.mkdir()
+    monkeypatch.setattr(downloader, "PATH_TO_GISAID", str(work_dir))
+    data = make_archive()
+    src_file = down_dir / ARCHIVES["metadata"]
+    src_file.write_bytes(data)
+    checksum = hashlib.sha256(data).hexdigest()
+    new_downloader(down_dir).move_archive("metadata_tsv_", str(src_file), checksum)
+    assert not src_file.exists()
+    assert (work_dir / ARCHIVES["metadata"]).read_bytes() == data
+    assert (work_dir / "metadata.tsv").exists()
+    assert (work_dir / (ARCHIVES["metadata"] + ".sha256")).read_text().split()[0] == checksum
+
+
+def test_move_archive_rejects_truncated_archive(tmp_path, monkeypatch):
+    down_dir, work_dir = tmp_path / "downloads", tmp_path / "gisaid"
+    down_dir.mkdir()
+    work_dir.mkdir()
+    monkeypatch.setattr(downloader, "PATH_TO_GISAID", str(work_dir))
+    data = make_archive()[:-64]
+    src_file = down_dir / ARCHIVES["metadata"]
+    src_file.write_bytes(data)
+    with pytest.raises(RuntimeError):
+        new_downloader(down_dir).move_archive("metadata_tsv_", str(src_file),
+                                              hashlib.sha256(data).hexdigest())
+    assert src_file.exists()
+    assert not os.listdir(str(work_dir))
+
+
+def test_move_archive_rejects_changed_file(tmp_path, monkeypatch):
+    monkeypatch.setattr(downloader, "PATH_TO_GISAID", str(tmp_path))
+    src_file = tmp_path / "downloads.tar.xz"
+    src_file.write_bytes(make_archive())
+    with pytest.raises(RuntimeError):
+        new_downloader(tmp_path).move_archive("metadata_tsv_", str(src_file), "0" * 64)
+
+
+def test_move_archive_replaces_earlier_extract(tmp_path, monkeypatch):
+    down_dir, work_dir = tmp_path / "downloads", tmp_path / "gisaid"
+    down_dir.mkdir()
+    work_dir.mkdir()
+    monkeypatch.setattr(downloader, "PATH_TO_GISAID", str(work_dir))
+    (work_dir / "metadata.tsv").write_text("old")
+    src_file = down_dir / ARCHIVES["metadata"]
+    src_file.write_bytes(make_archive(content=b"new"))
+    new_downloader(down_dir).move_archive("metadata_tsv_", str(src_file))
+    assert (work_dir / "metadata.tsv").read_text() == "new"
+    assert set(os.listdir(str(work_dir))) == {ARCHIVES["metadata"], "metadata.tsv"}
+
+
+class StubDriver(object):
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_dump_gisaid_closes_driver_on_timeout(tmp_path, monkeypatch):
+    driver = StubDriver()
+    gdl = new_downloader(tmp_path, driver=driver, download_timeout=0.2)
+    monkeypatch.setattr(gdl, "login", lambda: None)
+    monkeypatch.setattr(gdl, "download_fasta", lambda: None)
+    with pytest.raises(TimeoutError):
+        gdl.dump_gisaid()
+    assert driver.closed
+
+
+@pytest.fixture
+def standin_server(tmp_path):
+    """Serve the stand-in page and write archives when a download is requested"""
+    down_dir = tmp_path / "downloads"
+    down_dir.mkdir()
+    writers = []
+
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.startswith("/download?kind="):
+                kind = self.path.split("=", 1)[1]
+                writers.append(start_writer(str(down_dir), ARCHIVES[kind], make_archive()))
+                self.send_response(204)
+                self.end_headers()
+            else:
+                super().do_GET()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(Handler, directory=DATA_DIR))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "http://127.0.0.1:%s/gisaid_standin.html" % server.server_address[1], down_dir
+    server.shutdown()
+    for writer in writers:
+        writer.join()
+
+
+@pytest.fixture
+def chrome():
+    from selenium import webdriver
+    try:
+        options = webdriver.ChromeOptions()
+        options.add_argument("--headless")
+        driver = webdriver.Chrome(options=options)
+    except Exception as e:
+        pytest.skip("Chrome webdriver not available: %r" % e)
+    yield driver
+    driver.quit()
+
+
+def test_dump_gisaid_with_standin_page(standin_server, chrome, tmp_path, monkeypatch):
+    url, down_dir = standin_server
+    work_dir = tmp_path / "gisaid"
+    work_dir.mkdir()
+    monkeypatch.setattr(downloader, "PATH_TO_GISAID", str(work_dir))
+    gdl = new_downloader(down_dir, driver=chrome, url=url, timeout=10)
+    gdl.dump_gisaid()
+    for name in ARCHIVES.values():
+        assert (work_dir / name).exists()
+        assert (work_dir / (name + ".sha256")).exists()
@@ -0,0 +1,30 @@
+import os
+
+from radx import memory
+
+
+def test_disk_usage_skips_links(tmp_path):
+    (tmp_path / "a.bam").write_bytes(b"x" * 100)
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "sub" / "b.tmp").write_bytes(b"x" * 50)
+    os.symlink(str(tmp_path / "a.bam"), str(tmp_path / "link.bam"))
+    assert memory.disk_usage(str(tmp_path)) == 150
+
+
+def test_disk_usage_ignores_deleted_files(tmp_path, monkeypatch):
+    (tmp_path / "a.bam").write_bytes(b"x" * 100)
+    (tmp_path / "sort.tmp.0000.bam").write_bytes(b"x" * 50)
+    lstat = os.lstat
+
+    # samtools sort removes its temporary file between the walk and the stat
+    def vanishing_lstat(path):
+        if path.endswith(".tmp.0000.bam"):
+            raise FileNotFoundError(path)
+        return lstat(path)
+
+    monkeypatch.setattr(memory.os, "lstat", vanishing_lstat)
+    assert memory.disk_usage(str(tmp_path)) == 100
+
+
+def test_disk_usage_of_missing_dir(tmp_path):
+    assert memory.disk_usage(str(tmp_path / "gone")) == 0
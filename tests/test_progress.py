@@ -0,0 +1,68 @@
+import json
+import queue
+import time
+
+from radx import progress
+
+
+def read_records(path):
+    return [json.loads(line) for line in open(str(path))]
+
+
+def test_handle_tracks_stages_and_writes_records(tmp_path):
+    log_path = tmp_path / "progress.jsonl"
+    monitor = progress.ProgressMonitor(2, str(log_path))
+    events = queue.Queue()
+    events.put(("S1", "start", "align", 100.0, None, None))
+    events.put(("S2", "start", "align", 101.0, None, None))
+    events.put(("S1", "finish", "align", 110.0, 10.0, None))
+    events.put(("S1", "start", "trim_to_bam", 110.0, None, None))
+    events.put(("S2", "fail", "align", 111.0, 10.0, "'bwa mem' returned 1"))
+    monitor.drain(events)
+    assert monitor.current == {"S1": ("trim_to_bam", 110.0)}
+    monitor.exited("S2", 1)
+    monitor.close()
+    records = read_records(log_path)
+    assert [(x["sample"], x["event"], x["stage"]) for x in records] == [
+        ("S1", "start", "align"), ("S2", "start", "align"), ("S1", "finish", "align"),
+        ("S1", "start", "trim_to_bam"), ("S2", "fail", "align"), ("S2", "exit", None)]
+    assert records[2]["duration"] == 10.0
+    assert records[4]["message"] == "'bwa mem' returned 1"
+    assert records[5]["message"] == "1"
+
+
+def test_stuck_after_stage_timeout(tmp_path):
+    log_path = tmp_path / "progress.jsonl"
+    monitor = progress.ProgressMonitor(2, str(log_path), stage_timeout=60)
+    now = time.time()
+    monitor.handle("S1", "start", "variants", now - 120)
+    monitor.handle("S2", "start", "align", now - 10)
+    assert monitor.stuck() == [("S1", "variants")]
+    monitor.killed("S1", "variants")
+    assert monitor.stuck() == []
+    assert "S1" not in monitor.current
+    monitor.close()
+    assert read_records(log_path)[-1]["event"] == "killed"
+
+
+def test_no_stuck_samples_without_timeout(tmp_path):
+    monitor = progress.ProgressMonitor(1, str(tmp_path / "progress.jsonl"))
+    monitor.handle("S1", "start", "align", time.time() - 10**6)
+    assert monitor.stuck() == []
+    monitor.close()
+
+
+def test_report_throughput_and_eta(tmp_path, capsys):
+    monitor = progress.ProgressMonitor(4, str(tmp_path / "progress.jsonl"))
+    # two samples finished in an hour leave an hour for the other two
+    monitor.started = time.time() - 3600
+    monitor.exited("S1", 0)
+    monitor.exited("S2", -15)
+    monitor.handle("S3", "start", "plot", time.time())
+    monitor.report()
+    assert capsys.readouterr().out == ""
+    monitor.report(force=True)
+    out = capsys.readouterr().out
+    assert "Finished 2/4 samples (1 failed), 2.0 samples/hour, ETA 1h00m" in out
+    assert out.strip().endswith("Running: S3:plot")
+    monitor.close()
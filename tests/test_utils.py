@@ -0,0 +1,64 @@
+import pytest
+
+pytest.importorskip("pandas")
+pytest.importorskip("vcf")
+from radx import utils
+
+NAME = "S1"
+IVAR_COLUMNS = ["REGION", "POS", "REF", "ALT", "REF_DP", "REF_RV", "REF_QUAL", "ALT_DP", "ALT_RV",
+                "ALT_QUAL", "ALT_FREQ", "TOTAL_DP", "PVAL", "PASS", "GFF_FEATURE", "REF_CODON",
+                "REF_AA", "ALT_CODON", "ALT_AA"]
+# position, ref, alt and allele frequency of each call: C241T is a clear
+# call, A23403G is below the merged cutoff and G100T is below the ivar cutoff
+IVAR_CALLS = [(100, "G", "T", 0.005), (241, "C", "T", 0.9), (23403, "A", "G", 0.03)]
+LOFREQ_CALLS = [(100, "G", "T", 0.2), (241, "C", "T", 0.9), (23403, "A", "G", 0.03)]
+VCF_HEADER = """##fileformat=VCFv4.0
+##INFO=<ID=DP,Number=1,Type=Integer,Description="Raw Depth">
+##INFO=<ID=AF,Number=1,Type=Float,Description="Allele Frequency">
+##INFO=<ID=DP4,Number=4,Type=Integer,Description="Counts for ref-forward bases, ref-reverse, alt-forward and alt-reverse bases">
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO
+"""
+
+
+@pytest.fixture
+def sample_dir(tmp_path):
+    with open(str(tmp_path / (NAME + "_ivar.tsv")), "w") as ofile:
+        print("\t".join(IVAR_COLUMNS), file=ofile)
+        for pos, ref, alt, freq in IVAR_CALLS:
+            print("\t".join(map(str, ["NC_045512.2", pos, ref, alt, 100, 50, 35, 1000, 500, 35, freq,
+                                      1100, 0, "TRUE", "NA", "NA", "NA", "NA", "NA"])), file=ofile)
+    with open(str(tmp_path / (NAME + "_lofreq.vcf")), "w") as ofile:
+        ofile.write(VCF_HEADER)
+        for pos, ref, alt, freq in LOFREQ_CALLS:
+            print("\t".join(map(str, ["NC_045512.2", pos, ".", ref, alt, 100, "PASS",
+                                      "DP=1100;AF=%s;DP4=50,50,500,500" % freq])), file=ofile)
+    return tmp_path
+
+
+def test_remerge_sample_rewrites_only_variants(sample_dir):
+    metrics = sample_dir / (NAME + "_metrics.tsv")
+    metrics.write_text("\t".join([NAME, "99.5", "1000", "50.2", "old"]))
+    assert utils.remerge_sample(str(sample_dir), NAME) == (NAME, 1)
+    assert metrics.read_text() == "\t".join([NAME, "99.5", "1000", "50.2", "C241T"])
+    assert (sample_dir / (NAME + "_variants_merged.tsv")).exists()
+
+
+def test_remerge_sample_applies_cutoffs(sample_dir):
+    metrics = sample_dir / (NAME + "_metrics.tsv")
+    metrics.write_text("\t".join([NAME, "99.5", "1000", "50.2", "old"]))
+    utils.remerge_sample(str(sample_dir), NAME, min_af=0.01, ivar_min_af=0.001)
+    # G100T now passes the ivar cutoff but not the merged one
+    assert metrics.read_text().split("\t")[4] == "C241T,A23403G"
+
+
+@pytest.mark.parametrize("content", [None, "", "\t".join([NAME, "99.5"])])
+def test_remerge_sample_leaves_bad_metrics(sample_dir, content):
+    metrics = sample_dir / (NAME + "_metrics.tsv")
+    if content is not None:
+        metrics.write_text(content)
+    assert utils.remerge_sample(str(sample_dir), NAME) == (NAME, 1)
+    if content is None:
+        assert not metrics.exists()
+    else:
+        assert metrics.read_text() == content
+    assert (sample_dir / (NAME + "_variants_merged.tsv")).exists()